@@ -1,17 +1,33 @@
-from flask import Flask, request, jsonify, render_template, send_file
-import pandas as pd
-import numpy as np
+from flask import (Flask, Response, request, jsonify, render_template, send_from_directory,
+                   stream_with_context)
+from werkzeug.exceptions import NotFound
 from datetime import datetime
 import os
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+import xlsxwriter
 from pathlib import Path
 import sqlite3
 import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import functools
+import itertools
+import math
+from contextlib import contextmanager
 import time
+import socket
 import sys
+import re
+import zipfile
+import tempfile
+from xml.sax.saxutils import escape
 import webbrowser
 from flask_cors import CORS
+from flask_caching import Cache
+from flask_compress import Compress
+import msgspec
+import orjson
+from typing import List, Optional
 
 # ========================= 核心配置与全局变量 =========================
 # 全局配置
@@ -21,24 +37,31 @@ DEFAULT_CONFIG = {
     "default_period": "2026.01.01-2026.02.28"
 }
 
+# 查询结果缓存（Flask应用创建后init_app；读多写少的查询短时缓存，数据变更时主动失效）
+cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+QUERY_CACHE_TIMEOUT = 30
+
 # 解决打包后路径问题（统一所有路径使用此函数）
+# 基础路径启动时确定一次：PyInstaller 创建的临时文件夹 / 开发环境路径
+_BASE_PATH = sys._MEIPASS if hasattr(sys, '_MEIPASS') else os.path.abspath(".")
+
+@functools.lru_cache(maxsize=128)
 def resource_path(relative_path):
-    """获取打包后文件的绝对路径（全局统一使用）"""
-    if hasattr(sys, '_MEIPASS'):
-        # PyInstaller 创建的临时文件夹
-        base_path = sys._MEIPASS
-    else:
-        # 开发环境路径
-        base_path = os.path.abspath(".")
-    return os.path.join(base_path, relative_path)
+    """获取打包后文件的绝对路径（全局统一使用，结果缓存）"""
+    return os.path.join(_BASE_PATH, relative_path)
 
 # 全局标记：避免重复初始化数据库
 DB_INITIALIZED = False
+# 全局共享连接（init_db中创建一次），读写操作均通过_CONN_LOCK串行化
+_CONN = None
+_CONN_LOCK = threading.Lock()
+# 共享连接定期执行 PRAGMA optimize 的间隔（秒）
+OPTIMIZE_INTERVAL = 24 * 60 * 60
 
 # ========================= 数据库操作（修复路径问题） =========================
 def init_db():
-    """初始化数据库（统一使用resource_path）"""
-    global DB_INITIALIZED
+    """初始化数据库并创建全局共享连接（统一使用resource_path）"""
+    global DB_INITIALIZED, _CONN
     if DB_INITIALIZED:
         return
     
@@ -47,11 +70,21 @@ def init_db():
     # 确保dist文件夹存在
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     
-    # 建立连接，关闭线程检查（关键）
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # 建立连接，关闭线程检查（关键）；autocommit模式，事务由get_conn显式管理
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    # 全局使用Row：查询结果可按列名访问，无需再逐行转换
+    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
     try:
+        # WAL模式下读写互不阻塞，连接常驻后页缓存在请求间保留
+        cursor.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-20000;
+        ''')
+        
         # 创建客户表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS customers (
@@ -98,582 +131,821 @@ def init_db():
         )
         ''')
         
-        conn.commit()
-        DB_INITIALIZED = True
-        print(f"数据库初始化成功！路径：{db_path}")
+        # 创建索引：按时间排序、按客户筛选、按客户+设备查最后一次抄表
+        cursor.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_hist_calc_time ON calculation_history(calculate_time DESC);
+        CREATE INDEX IF NOT EXISTS idx_hist_company ON calculation_history(company_name, calculate_time DESC);
+        CREATE INDEX IF NOT EXISTS idx_hist_meter ON calculation_history(company_name, model, serial, calculate_time DESC);
+        CREATE INDEX IF NOT EXISTS idx_cust_update ON customers(update_time DESC);
+        ANALYZE;
+        ''')
     except Exception as e:
-        conn.rollback()
+        conn.close()
         print(f"数据库初始化失败：{str(e)}")
         raise
-    finally:
+    
+    _CONN = conn
+    atexit.register(_CONN.close)
+    _schedule_optimize()
+    DB_INITIALIZED = True
+    print(f"数据库初始化成功！路径：{db_path}")
+
+@contextmanager
+def get_conn(write=False):
+    """获取全局共享连接（加锁）：写操作包在单个事务中
+    
+    读操作同样加锁：同一连接上的读会看到其他线程未提交的写入，
+    WAL的读写并发只存在于不同连接之间（长时间读取请使用get_read_conn）
+    """
+    if _CONN is None:
+        init_db()
+    if not write:
+        with _CONN_LOCK:
+            yield _CONN
+        return
+    
+    with _CONN_LOCK:
+        _CONN.execute('BEGIN')
         try:
-            if not conn.closed:
-                conn.close()
-        except:
-            pass
+            yield _CONN
+        except Exception:
+            _CONN.execute('ROLLBACK')
+            raise
+        _CONN.execute('COMMIT')
+
+@contextmanager
+def get_read_conn():
+    """打开独立只读连接（WAL快照）：供导出等长时间流式读取使用，不占用共享连接"""
+    if _CONN is None:
+        init_db()
+    conn = sqlite3.connect(resource_path("dist/printer_fee.db"), check_same_thread=False,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        # 显式开启读事务，期间的多次查询读取同一快照
+        conn.execute('BEGIN')
+        yield conn
+    finally:
+        conn.close()
+
+def _compact_db():
+    """回收已删除数据占用的空间并截断WAL文件（须在事务外执行；失败不影响业务）"""
+    try:
+        with _CONN_LOCK:
+            _CONN.execute('VACUUM')
+            # 有只读快照（导出、流式历史）未结束时截断会一直等待，期间阻塞所有数据库操作；
+            # 截断时不等待，本次截断不了就留到下次
+            timeout = _CONN.execute('PRAGMA busy_timeout').fetchone()[0]
+            _CONN.execute('PRAGMA busy_timeout = 0')
+            try:
+                busy, log_pages, checkpointed = _CONN.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            finally:
+                _CONN.execute(f'PRAGMA busy_timeout = {int(timeout)}')
+        if busy:
+            print(f"WAL截断未完成（存在未结束的读取）：已写回{checkpointed}/{log_pages}页")
+    except Exception as e:
+        print(f"数据库整理失败：{str(e)}")
+
+def _schedule_optimize():
+    """定时执行 PRAGMA optimize（常驻连接下按需更新查询统计信息），每次执行后重新计时"""
+    timer = threading.Timer(OPTIMIZE_INTERVAL, _run_optimize)
+    timer.daemon = True
+    timer.start()
+
+def _run_optimize():
+    try:
+        with _CONN_LOCK:
+            _CONN.execute('PRAGMA optimize')
+    except Exception as e:
+        print(f"数据库优化失败：{str(e)}")
+    _schedule_optimize()
 
 def add_or_update_customer(company_name, invoice_type):
     """添加/更新客户信息（统一路径）"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    
     try:
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('SELECT id FROM customers WHERE company_name = ?', (company_name,))
-        result = cursor.fetchone()
-        
-        if result:
-            customer_id = result[0]
-            cursor.execute('''
-            UPDATE customers SET invoice_type = ?, update_time = ? WHERE id = ?
-            ''', (invoice_type, now, customer_id))
-        else:
-            cursor.execute('''
-            INSERT INTO customers (company_name, invoice_type, create_time, update_time)
-            VALUES (?, ?, ?, ?)
-            ''', (company_name, invoice_type, now, now))
-            customer_id = cursor.lastrowid
+        with get_conn(write=True) as c:
+            cursor = c.cursor()
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute('SELECT id FROM customers WHERE company_name = ?', (company_name,))
+            result = cursor.fetchone()
+            
+            if result:
+                customer_id = result['id']
+                cursor.execute('''
+                UPDATE customers SET invoice_type = ?, update_time = ? WHERE id = ?
+                ''', (invoice_type, now, customer_id))
+            else:
+                cursor.execute('''
+                INSERT INTO customers (company_name, invoice_type, create_time, update_time)
+                VALUES (?, ?, ?, ?)
+                ''', (company_name, invoice_type, now, now))
+                customer_id = cursor.lastrowid
         
-        conn.commit()
+        _invalidate_customer_cache()
         return customer_id
     except Exception as e:
-        conn.rollback()
+        # 写入失败同样清空缓存，不保留事务期间可能读到的数据
+        _invalidate_customer_cache()
         print(f"添加/更新客户失败：{str(e)}")
         raise
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
 
-def get_customer_list():
-    """获取所有客户名称列表"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    
-    try:
+def _invalidate_customer_cache():
+    """客户信息变更后清空客户缓存"""
+    cache.delete_memoized(_load_customer_info)
+    cache.delete_memoized(_load_customer_list)
+
+def _invalidate_calculation_cache():
+    """计算记录变更后清空计算记录缓存"""
+    cache.delete_memoized(_load_all_calculations)
+    cache.delete_memoized(_load_customer_calculations)
+
+@cache.memoize(timeout=QUERY_CACHE_TIMEOUT)
+def _load_customer_list():
+    """查询客户名称列表（短时缓存；查询异常直接抛出，不进入缓存）"""
+    with get_conn() as c:
+        cursor = c.cursor()
         cursor.execute('SELECT company_name FROM customers ORDER BY update_time DESC')
         rows = cursor.fetchall()
-        return [row[0] for row in rows]
+    return [row['company_name'] for row in rows]
+
+def get_customer_list():
+    """获取所有客户名称列表（带缓存）"""
+    try:
+        return _load_customer_list()
     except Exception as e:
         print(f"获取客户列表失败：{str(e)}")
         return []
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
 
-def get_customer_info(company_name):
-    """根据公司名称获取客户详情"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    
-    try:
+@cache.memoize(timeout=QUERY_CACHE_TIMEOUT)
+def _load_customer_info(company_name):
+    """查询客户详情（按公司名称短时缓存；查询异常直接抛出，不进入缓存）"""
+    with get_conn() as c:
+        cursor = c.cursor()
         cursor.execute('SELECT * FROM customers WHERE company_name = ?', (company_name,))
         row = cursor.fetchone()
-        if row:
-            return {
-                "id": row[0],
-                "company_name": row[1],
-                "invoice_type": row[2]
-            }
-        return None
+    if row:
+        return {
+            "id": row['id'],
+            "company_name": row['company_name'],
+            "invoice_type": row['invoice_type']
+        }
+    return None
+
+def get_customer_info(company_name):
+    """根据公司名称获取客户详情（带缓存）"""
+    try:
+        customer_info = _load_customer_info(company_name)
+        return dict(customer_info) if customer_info else None
     except Exception as e:
         print(f"获取客户详情失败：{str(e)}")
         return None
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
 
 def get_last_meter_data(company_name, model, serial):
     """获取最后一次抄表数据"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-        SELECT second_black, second_color, second_date 
-        FROM calculation_history 
-        WHERE company_name = ? AND model = ? AND serial = ?
-        ORDER BY calculate_time DESC LIMIT 1
-        ''', (company_name, model, serial))
-        row = cursor.fetchone()
+        with get_conn() as c:
+            cursor = c.cursor()
+            cursor.execute('''
+            SELECT second_black, second_color, second_date 
+            FROM calculation_history 
+            WHERE company_name = ? AND model = ? AND serial = ?
+            ORDER BY calculate_time DESC LIMIT 1
+            ''', (company_name, model, serial))
+            row = cursor.fetchone()
         if row:
             return {
-                "last_black": row[0],
-                "last_color": row[1],
-                "last_date": row[2]
+                "last_black": row['second_black'],
+                "last_color": row['second_color'],
+                "last_date": row['second_date']
             }
         return None
     except Exception as e:
         print(f"获取抄表数据失败：{str(e)}")
         return None
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
+
+# calculation_history插入列（顺序即参数顺序）；SQL固定不变，每次执行命中sqlite3的语句缓存
+_INSERT_COLS = (
+    "customer_id", "company_name", "invoice_type",
+    "location", "ip", "model", "serial", "first_date", "second_date",
+    "first_black", "first_color", "second_black", "second_color",
+    "package_black", "package_color", "basic_fee", "used_black", "used_color",
+    "over_black", "over_color", "over_fee_black", "over_fee_color",
+    "total_fee", "period", "black_price", "color_price", "calculate_time"
+)
+_INSERT_SQL = (f"INSERT INTO calculation_history ({', '.join(_INSERT_COLS)}) "
+               f"VALUES ({', '.join('?' * len(_INSERT_COLS))})")
+# 仅以下三列可缺省；其余列（计算结果）缺失时抛出KeyError，避免写入NULL导致后续导出失败
+_DEFAULTS = {"customer_id": 0, "company_name": "", "invoice_type": "增税"}
 
 def add_calculation(data):
     """添加计算记录"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    
+    add_calculations([data])
+
+def add_calculations(data_list):
+    """批量添加计算记录（单个事务内executemany，只提交一次）"""
+    params = [tuple(row[col] for col in _INSERT_COLS) for row in ({**_DEFAULTS, **data} for data in data_list)]
     try:
-        cursor.execute('''
-        INSERT INTO calculation_history (
-            customer_id, company_name, invoice_type,
-            location, ip, model, serial, first_date, second_date,
-            first_black, first_color, second_black, second_color,
-            package_black, package_color, basic_fee, used_black, used_color,
-            over_black, over_color, over_fee_black, over_fee_color,
-            total_fee, period, black_price, color_price, calculate_time
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data.get('customer_id', 0),
-            data.get('company_name', ''),
-            data.get('invoice_type', '增税'),
-            data['location'], data['ip'], data['model'], data['serial'],
-            data['first_date'], data['second_date'], data['first_black'],
-            data['first_color'], data['second_black'], data['second_color'],
-            data['package_black'], data['package_color'], data['basic_fee'],
-            data['used_black'], data['used_color'], data['over_black'],
-            data['over_color'], data['over_fee_black'], data['over_fee_color'],
-            data['total_fee'], data['period'], data['black_price'],
-            data['color_price'], data['calculate_time']
-        ))
-        conn.commit()
+        with get_conn(write=True) as c:
+            c.executemany(_INSERT_SQL, params)
+        _invalidate_calculation_cache()
     except Exception as e:
-        conn.rollback()
         print(f"添加计算记录失败：{str(e)}")
         raise
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
 
-def get_all_calculations():
-    """获取所有计算记录"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    try:
+@cache.memoize(timeout=QUERY_CACHE_TIMEOUT)
+def _load_all_calculations():
+    """查询所有计算记录（短时缓存；查询异常直接抛出，不进入缓存）"""
+    with get_conn() as c:
+        cursor = c.cursor()
         cursor.execute('SELECT * FROM calculation_history ORDER BY calculate_time DESC')
         rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+    # 缓存后端需要pickle，sqlite3.Row不可序列化，缓存的结果仍转为dict
+    return [dict(row) for row in rows]
+
+def get_all_calculations():
+    """获取所有计算记录（带缓存）"""
+    try:
+        return _load_all_calculations()
     except Exception as e:
         print(f"获取计算记录失败：{str(e)}")
         return []
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
 
-def get_customer_calculations(company_name):
-    """获取指定客户的所有计算记录"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    try:
+@cache.memoize(timeout=QUERY_CACHE_TIMEOUT)
+def _load_customer_calculations(company_name):
+    """查询指定客户的所有计算记录（短时缓存；查询异常直接抛出，不进入缓存）"""
+    with get_conn() as c:
+        cursor = c.cursor()
         cursor.execute('''
         SELECT * FROM calculation_history 
         WHERE company_name = ? 
         ORDER BY calculate_time DESC
         ''', (company_name,))
         rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+    # 缓存后端需要pickle，sqlite3.Row不可序列化，缓存的结果仍转为dict
+    return [dict(row) for row in rows]
+
+def get_customer_calculations(company_name):
+    """获取指定客户的所有计算记录（带缓存）"""
+    try:
+        return _load_customer_calculations(company_name)
     except Exception as e:
         print(f"获取客户计算记录失败：{str(e)}")
         return []
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
+
+def iter_calculations(company_name=None):
+    """逐行读取计算记录（按时间倒序，可按客户筛选），在独立只读连接上流式返回"""
+    with get_read_conn() as c:
+        if company_name:
+            cursor = c.execute('''
+            SELECT * FROM calculation_history 
+            WHERE company_name = ? 
+            ORDER BY calculate_time DESC
+            ''', (company_name,))
+        else:
+            cursor = c.execute('SELECT * FROM calculation_history ORDER BY calculate_time DESC')
+        yield from cursor
+
+def get_calculations_grouped(conn, offset=0, limit=-1):
+    """按客户分组逐行读取计算记录，返回 (公司名称, 记录迭代器) 的迭代器（不一次性加载到内存）
+    
+    offset/limit 用于分段导出，limit为-1时不限制条数
+    """
+    # 排序与 idx_hist_company 一致，直接按索引顺序扫描、无需临时排序；id 保证同一时间的记录顺序稳定
+    cursor = conn.execute('''
+    SELECT * FROM calculation_history 
+    ORDER BY company_name, calculate_time DESC, id
+    LIMIT ? OFFSET ?
+    ''', (limit, offset))
+    return itertools.groupby(cursor, key=lambda row: row['company_name'])
+
+def get_calculation_totals(conn):
+    """由SQLite直接汇总基本费、超印费、总费用"""
+    row = conn.execute('''
+    SELECT COALESCE(SUM(basic_fee), 0), COALESCE(SUM(over_fee_black + over_fee_color), 0),
+           COALESCE(SUM(total_fee), 0)
+    FROM calculation_history
+    ''').fetchone()
+    return {
+        "total_basic_fee": row[0],
+        "total_over_fee": row[1],
+        "total_all_fee": row[2]
+    }
 
 def clear_calculations():
     """清空计算记录"""
-    db_path = resource_path("dist/printer_fee.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('DELETE FROM calculation_history')
-        conn.commit()
+        with get_conn(write=True) as c:
+            c.execute('DELETE FROM calculation_history')
+            # 自增序号从头开始
+            c.execute("DELETE FROM sqlite_sequence WHERE name = 'calculation_history'")
+        _invalidate_calculation_cache()
+        # 清空后收缩数据库文件和WAL，避免文件只增不减
+        _compact_db()
     except Exception as e:
-        conn.rollback()
         print(f"清空计算记录失败：{str(e)}")
         raise
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
 
-# ========================= 核心业务逻辑（无修改） =========================
-def validate_inputs(data):
-    """验证输入数据有效性"""
-    try:
-        if not data.get("company_name", "").strip():
-            return {
-                "valid": False,
-                "error": "公司名称不能为空"
-            }
-        
-        numeric_fields = [
-            "first_black", "first_color", "second_black", "second_color",
-            "package_black", "package_color", "basic_fee"
-        ]
-        for field in numeric_fields:
-            float(data.get(field, 0))
-        
-        first_black = int(data.get("first_black", 0))
-        second_black = int(data.get("second_black", 0))
-        first_color = int(data.get("first_color", 0))
-        second_color = int(data.get("second_color", 0))
-        
-        warnings = []
-        if second_black < first_black:
-            warnings.append("第二次抄表黑色张数不能小于第一次")
-        if second_color < first_color:
-            warnings.append("第二次抄表彩色张数不能小于第一次")
-        
-        return {
-            "valid": True,
-            "warnings": warnings
-        }
-    except ValueError as e:
-        return {
-            "valid": False,
-            "error": f"数字输入错误：{str(e)}"
-        }
+# ========================= 核心业务逻辑 =========================
+class CalcInput(msgspec.Struct):
+    """计算请求参数（按声明类型解码，兼容以字符串形式提交的数字）"""
+    company_name: str = ""
+    invoice_type: str = "增税"
+    location: str = ""
+    ip: str = ""
+    model: str = ""
+    serial: str = ""
+    first_date: str = "2025.10.31"
+    second_date: str = "2025.12.31"
+    # 张数按float解码后取整（与原先int()截断小数的行为一致）
+    first_black: float = 0
+    first_color: float = 0
+    second_black: float = 0
+    second_color: float = 0
+    package_black: float = 0
+    package_color: float = 0
+    basic_fee: float = 0.0
+    # 未提交时使用全局配置的单价和周期
+    black_price: Optional[float] = None
+    color_price: Optional[float] = None
+    period: Optional[str] = None
+    customer_id: int = 0
+    
+    def __post_init__(self):
+        # 宽松模式下"nan"/"inf"等字符串也能解码为float，写入后会导致导出失败，在此拒绝
+        for name in _CALC_FLOAT_FIELDS:
+            value = getattr(self, name)
+            if value is not None and not math.isfinite(value):
+                raise ValueError(f"{name}: 必须为有限数值")
+        for name in _CALC_COUNT_FIELDS:
+            setattr(self, name, int(getattr(self, name)))
 
-def calculate_cost(data, config=DEFAULT_CONFIG):
+_CALC_COUNT_FIELDS = ("first_black", "first_color", "second_black", "second_color",
+                      "package_black", "package_color")
+_CALC_FLOAT_FIELDS = _CALC_COUNT_FIELDS + ("basic_fee", "black_price", "color_price")
+
+class CalcResult(msgspec.Struct):
+    """计算结果（字段顺序与calculation_history表一致）"""
+    customer_id: int
+    company_name: str
+    invoice_type: str
+    location: str
+    ip: str
+    model: str
+    serial: str
+    first_date: str
+    second_date: str
+    first_black: int
+    first_color: int
+    second_black: int
+    second_color: int
+    package_black: int
+    package_color: int
+    basic_fee: float
+    used_black: int
+    used_color: int
+    over_black: int
+    over_color: int
+    over_fee_black: float
+    over_fee_color: float
+    total_fee: float
+    period: str
+    black_price: float
+    color_price: float
+    calculate_time: str
+
+CALC_DECODER = msgspec.json.Decoder(CalcInput, strict=False)
+CALC_BATCH_DECODER = msgspec.json.Decoder(List[CalcInput], strict=False)
+
+def validate_inputs(calc):
+    """验证输入数据有效性（数字格式已在解码时校验）"""
+    if not calc.company_name.strip():
+        return {"valid": False, "error": "公司名称不能为空"}
+    
+    warnings = []
+    if calc.second_black < calc.first_black:
+        warnings.append("第二次抄表黑色张数不能小于第一次")
+    if calc.second_color < calc.first_color:
+        warnings.append("第二次抄表彩色张数不能小于第一次")
+    return {"valid": True, "warnings": warnings}
+
+def calculate_cost(calc, config=DEFAULT_CONFIG):
     """核心计算逻辑"""
-    try:
-        company_name = data.get("company_name", "")
-        invoice_type = data.get("invoice_type", "增税")
-        
-        location = data.get("location", "")
-        ip = data.get("ip", "")
-        model = data.get("model", "")
-        serial = data.get("serial", "")
-        
-        first_date = data.get("first_date", "2025.10.31")
-        second_date = data.get("second_date", "2025.12.31")
-        first_black = int(data.get("first_black", 0))
-        first_color = int(data.get("first_color", 0))
-        second_black = int(data.get("second_black", 0))
-        second_color = int(data.get("second_color", 0))
-        
-        package_black = int(data.get("package_black", 0))
-        package_color = int(data.get("package_color", 0))
-        basic_fee = float(data.get("basic_fee", 0))
-        
-        black_price = float(data.get("black_price", config["black_overprint_price"]))
-        color_price = float(data.get("color_price", config["color_overprint_price"]))
-        period = data.get("period", config["default_period"])
-        
-        # 核心计算
-        used_black = second_black - first_black
-        used_color = second_color - first_color
-        
-        over_black = max(used_black - package_black, 0)
-        over_color = max(used_color - package_color, 0)
-        
-        over_fee_black = round(over_black * black_price, 2)
-        over_fee_color = round(over_color * color_price, 2)
-        
-        total_fee = round(over_fee_black + over_fee_color + basic_fee, 2)
-        
-        # 组装结果
-        result = {
-            "customer_id": data.get("customer_id", 0),
-            "company_name": company_name,
-            "invoice_type": invoice_type,
-            "location": location,
-            "ip": ip,
-            "model": model,
-            "serial": serial,
-            "first_date": first_date,
-            "second_date": second_date,
-            "first_black": first_black,
-            "first_color": first_color,
-            "second_black": second_black,
-            "second_color": second_color,
-            "package_black": package_black,
-            "package_color": package_color,
-            "basic_fee": basic_fee,
-            "used_black": used_black,
-            "used_color": used_color,
-            "over_black": over_black,
-            "over_color": over_color,
-            "over_fee_black": over_fee_black,
-            "over_fee_color": over_fee_color,
-            "total_fee": total_fee,
-            "period": period,
-            "black_price": black_price,
-            "color_price": color_price,
-            "calculate_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        return {
-            "success": True,
-            "data": result,
-            "warnings": []
-        }
-    except Exception as e:
-        return {
-            "success": False,
-            "error": str(e)
-        }
+    black_price = calc.black_price if calc.black_price is not None else config["black_overprint_price"]
+    color_price = calc.color_price if calc.color_price is not None else config["color_overprint_price"]
+    period = calc.period if calc.period is not None else config["default_period"]
+    
+    # 核心计算
+    used_black = calc.second_black - calc.first_black
+    used_color = calc.second_color - calc.first_color
+    
+    over_black = max(used_black - calc.package_black, 0)
+    over_color = max(used_color - calc.package_color, 0)
+    
+    over_fee_black = round(over_black * black_price, 2)
+    over_fee_color = round(over_color * color_price, 2)
+    
+    total_fee = round(over_fee_black + over_fee_color + calc.basic_fee, 2)
+    
+    # 组装结果
+    return CalcResult(
+        customer_id=calc.customer_id,
+        company_name=calc.company_name,
+        invoice_type=calc.invoice_type,
+        location=calc.location,
+        ip=calc.ip,
+        model=calc.model,
+        serial=calc.serial,
+        first_date=calc.first_date,
+        second_date=calc.second_date,
+        first_black=calc.first_black,
+        first_color=calc.first_color,
+        second_black=calc.second_black,
+        second_color=calc.second_color,
+        package_black=calc.package_black,
+        package_color=calc.package_color,
+        basic_fee=calc.basic_fee,
+        used_black=used_black,
+        used_color=used_color,
+        over_black=over_black,
+        over_color=over_color,
+        over_fee_black=over_fee_black,
+        over_fee_color=over_fee_color,
+        total_fee=total_fee,
+        period=period,
+        black_price=black_price,
+        color_price=color_price,
+        calculate_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
 
-def export_to_excel(config=DEFAULT_CONFIG):
-    """Excel导出逻辑"""
-    try:
-        data_list = get_all_calculations()
-        if not data_list:
-            return {"success": False, "error": "暂无计算数据可导出"}
-        
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "打印机费用清单"
-        
-        # 样式定义
-        title_font = Font(name="微软雅黑", size=14, bold=True)
-        header_font = Font(name="微软雅黑", size=10, bold=True)
-        normal_font = Font(name="微软雅黑", size=9)
-        center_alignment = Alignment(horizontal="center", vertical="center")
-        left_alignment = Alignment(horizontal="left", vertical="center")
+# Excel单元格格式（模块级定义一次，每次导出按此注册到工作簿）
+TITLE_FORMAT = {'font_name': '微软雅黑', 'font_size': 14, 'bold': True,
+                'align': 'center', 'valign': 'vcenter'}
+INFO_FORMAT = {'font_name': '微软雅黑', 'font_size': 11, 'align': 'left', 'valign': 'vcenter'}
+HEADER_FORMAT = {'font_name': '微软雅黑', 'font_size': 10, 'bold': True,
+                 'align': 'center', 'valign': 'vcenter', 'bg_color': '#E6E6FA', 'border': 1}
+NORMAL_FORMAT = {'font_name': '微软雅黑', 'font_size': 9,
+                 'align': 'center', 'valign': 'vcenter', 'border': 1}
+GROUP_FORMAT = {'font_name': '微软雅黑', 'font_size': 10, 'bold': True,
+                'align': 'center', 'valign': 'vcenter', 'bg_color': '#F0F8FF'}
+SUMMARY_LABEL_FORMAT = {'font_name': '微软雅黑', 'font_size': 10, 'bold': True,
+                        'align': 'center', 'valign': 'vcenter', 'bg_color': '#E6E6FA'}
+SUMMARY_VALUE_FORMAT = {'font_name': '微软雅黑', 'font_size': 9, 'align': 'center', 'valign': 'vcenter'}
+TOTAL_FORMAT = {'font_name': '微软雅黑', 'font_size': 12, 'bold': True,
+                'align': 'center', 'valign': 'vcenter', 'bg_color': '#FFE4B5'}
+
+# 导出用到的全部样式（顺序即直接生成xlsx时cellXfs中的编号，0为默认样式）
+EXPORT_STYLES = {
+    'title': TITLE_FORMAT,
+    'info': INFO_FORMAT,
+    'header': HEADER_FORMAT,
+    'normal': NORMAL_FORMAT,
+    'group': GROUP_FORMAT,
+    'summary_label': SUMMARY_LABEL_FORMAT,
+    'summary_value': SUMMARY_VALUE_FORMAT,
+    'total': TOTAL_FORMAT,
+}
+
+# 导出表格的固定布局（列号从0开始）
+EXPORT_SHEET_NAME = "打印机费用清单"
+COLUMN_WIDTHS = [20, 25, 15, 18, 18, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 15]
+MERGE_RANGES_ROW3 = [(5, 6), (8, 9), (10, 11), (12, 13), (14, 15), (16, 18)]
+HEADERS_ROW4 = [
+    "", "", "", "", "", "黑色", "彩色", "", "黑色", "彩色",
+    "黑色", "彩色", "黑色", "彩色", "黑色", "彩色", "黑色", "彩色", "超印费小计"
+]
+SUMMARY_LABELS = ["租赁费", "超印费", "总费用"]
+# 单个导出文件最多的明细行数，超出时分段写入多个文件并打包为zip
+EXPORT_SEGMENT_SIZE = 50000
+
+def _export_headers_row3(first):
+    """生成第3行列标题（日期取自最近一条记录）"""
+    return [
+        "客户名称", "机器位置", "IP地址", "设备型号", "设备序号",
+        f"{first['first_date']}初始张数", "",
+        "基本费（元）", "包印张数", "",
+        f"{first['second_date']}抄表张数", "",
+        "使用张数", "", "超张数", "", "", "", ""
+    ]
+
+def _iter_export_rows(first, customer_groups, totals):
+    """按自上而下顺序生成导出表格的每一行
+    
+    first为最近一条记录（取表头信息），customer_groups为 (公司名称, 记录迭代器) 的迭代器；
+    每行为 (行号, 行高, 整行样式名, 单元格列表, 合并列区间列表)，行号、列号均从0开始；
+    整行同一样式时（列标题、明细行）单元格列表直接为值列表，整行写入；
+    否则整行样式为None，单元格为 (值, 样式名) 或 None；合并区间的值与样式取区间首个单元格；
+    totals为None时不生成汇总行（分段导出时只有最后一段带汇总）
+    """
+    # 1. 标题部分
+    yield 0, 25, None, [("上海库克打印机有限公司开票清单", 'title')], [(0, 17)]
+    yield 1, 20, None, [
+        (f"客户名称：{first['company_name']}", 'info'), None,
+        (f"发票类型：{first['invoice_type']}", 'info')
+    ], [(0, 1), (2, 3)]
+    
+    # 2. 列标题（第3行合并单元格）
+    yield 2, 30, 'header', _export_headers_row3(first), MERGE_RANGES_ROW3
+    yield 3, 20, 'header', HEADERS_ROW4, []
+    
+    # 3. 数据行：按客户名称分组
+    current_row = 4
+    for company_name, group_data in customer_groups:
+        # 客户分组标题
+        yield current_row, None, None, [(f"【{company_name}】", 'group')], [(0, 17)]
+        current_row += 1
         
-        thin_border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        header_fill = PatternFill(start_color="E6E6FA", end_color="E6E6FA", fill_type="solid")
-        total_fill = PatternFill(start_color="FFE4B5", end_color="FFE4B5", fill_type="solid")
-        no_border = Border(
-            left=Side(style='none'),
-            right=Side(style='none'),
-            top=Side(style='none'),
-            bottom=Side(style='none')
+        # 明细数据
+        for data in group_data:
+            row_data = [
+                company_name, data['location'], data['ip'], data['model'], data['serial'],
+                data['first_black'], data['first_color'], f"{data['basic_fee']:.2f}",
+                data['package_black'], data['package_color'],
+                data['second_black'], data['second_color'],
+                data['used_black'], data['used_color'],
+                data['over_black'], data['over_color'],
+                data['over_fee_black'], data['over_fee_color'],
+                data['over_fee_black'] + data['over_fee_color']
+            ]
+            yield current_row, None, 'normal', row_data, []
+            current_row += 1
+    
+    # 4. 汇总行（与明细之间空三行）
+    if totals is None:
+        return
+    summary_row = current_row + 3
+    yield summary_row, None, None, [
+        (SUMMARY_LABELS[0], 'summary_label'), None,
+        (first['period'], 'summary_value'), None,
+        (f"¥{totals['total_basic_fee']:.2f}", 'summary_value')
+    ], [(0, 1)]
+    yield summary_row + 1, None, None, [
+        (SUMMARY_LABELS[1], 'summary_label'), None,
+        (f"{first['first_date'][:7]}-{first['second_date'][:7]}", 'summary_value'), None,
+        (f"¥{totals['total_over_fee']:.2f}", 'summary_value')
+    ], [(0, 1)]
+    yield summary_row + 2, None, None, [
+        (SUMMARY_LABELS[2], 'total'), None, None, None,
+        (f"¥{totals['total_all_fee']:.2f}", 'total')
+    ], [(0, 3)]
+
+# ------------------------- 直接生成xlsx（zip + XML） -------------------------
+_XLSX_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_XLSX_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_COL_LETTERS = [chr(65 + i) for i in range(26)]
+# XML 1.0 不允许的控制字符
+_ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_XLSX_CONTENT_TYPES = _XML_DECL + (
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '<Override PartName="/xl/sharedStrings.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+    '</Types>'
+)
+_XLSX_ROOT_RELS = _XML_DECL + (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    f'<Relationship Id="rId1" Type="{_XLSX_REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_XLSX_WORKBOOK_RELS = _XML_DECL + (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    f'<Relationship Id="rId1" Type="{_XLSX_REL_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+    f'<Relationship Id="rId2" Type="{_XLSX_REL_NS}/styles" Target="styles.xml"/>'
+    f'<Relationship Id="rId3" Type="{_XLSX_REL_NS}/sharedStrings" Target="sharedStrings.xml"/>'
+    '</Relationships>'
+)
+
+def _xml_text(value):
+    """转义XML文本并去除非法控制字符"""
+    return escape(_ILLEGAL_XML_CHARS.sub('', value))
+
+def _xlsx_styles_xml(styles):
+    """根据xlsxwriter风格的格式字典生成styles.xml"""
+    fonts = ['<font><sz val="11"/><name val="Calibri"/></font>']
+    fills = ['<fill><patternFill patternType="none"/></fill>',
+             '<fill><patternFill patternType="gray125"/></fill>']
+    borders = ['<border><left/><right/><top/><bottom/><diagonal/></border>']
+    thin = '<{0} style="thin"><color auto="1"/></{0}>'
+    xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+    
+    def index_of(items, item):
+        if item not in items:
+            items.append(item)
+        return items.index(item)
+    
+    for fmt in styles.values():
+        font = (f'<font>{"<b/>" if fmt.get("bold") else ""}<sz val="{fmt.get("font_size", 11)}"/>'
+                f'<name val="{_xml_text(fmt.get("font_name", "Calibri"))}"/></font>')
+        font_id = index_of(fonts, font)
+        fill_id = 0
+        if fmt.get('bg_color'):
+            rgb = 'FF' + fmt['bg_color'].lstrip('#').upper()
+            fill_id = index_of(fills, f'<fill><patternFill patternType="solid"><fgColor rgb="{rgb}"/>'
+                                      f'<bgColor indexed="64"/></patternFill></fill>')
+        border_id = 0
+        if fmt.get('border'):
+            border_id = index_of(borders, '<border>' + ''.join(
+                thin.format(side) for side in ('left', 'right', 'top', 'bottom')) + '<diagonal/></border>')
+        xfs.append(
+            f'<xf numFmtId="0" fontId="{font_id}" fillId="{fill_id}" borderId="{border_id}" xfId="0" '
+            f'applyFont="1" applyFill="1" applyBorder="1" applyAlignment="1">'
+            f'<alignment horizontal="{fmt.get("align", "general")}" '
+            f'vertical="{fmt.get("valign", "vcenter").replace("vcenter", "center")}"/></xf>'
         )
+    
+    return _XML_DECL + (
+        f'<styleSheet xmlns="{_XLSX_NS}">'
+        f'<fonts count="{len(fonts)}">{"".join(fonts)}</fonts>'
+        f'<fills count="{len(fills)}">{"".join(fills)}</fills>'
+        f'<borders count="{len(borders)}">{"".join(borders)}</borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        f'<cellXfs count="{len(xfs)}">{"".join(xfs)}</cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    )
+
+# 样式表、样式编号、列宽在进程内只生成一次
+_XLSX_STYLES_XML = _xlsx_styles_xml(EXPORT_STYLES)
+_XLSX_STYLE_ATTRS = {name: f' s="{idx}"' for idx, name in enumerate(EXPORT_STYLES, 1)}
+_XLSX_COLS_XML = '<cols>' + ''.join(
+    f'<col min="{col}" max="{col}" width="{width}" customWidth="1"/>'
+    for col, width in enumerate(COLUMN_WIDTHS, 1)
+) + '</cols>'
+
+def _write_xlsx_xml(save_path, rows, shared_strings):
+    """直接生成xlsx文件：sheet1.xml逐行流式写入zip，绕开Excel库的逐单元格开销"""
+    style_attrs = _XLSX_STYLE_ATTRS
+    sst_index = {text: idx for idx, text in enumerate(shared_strings)}
+    merge_refs = []
+    
+    with zipfile.ZipFile(save_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        zf.writestr('[Content_Types].xml', _XLSX_CONTENT_TYPES)
+        zf.writestr('_rels/.rels', _XLSX_ROOT_RELS)
+        zf.writestr('xl/workbook.xml', _XML_DECL + (
+            f'<workbook xmlns="{_XLSX_NS}" xmlns:r="{_XLSX_REL_NS}"><sheets>'
+            f'<sheet name="{_xml_text(EXPORT_SHEET_NAME)}" sheetId="1" r:id="rId1"/>'
+            '</sheets></workbook>'
+        ))
+        zf.writestr('xl/_rels/workbook.xml.rels', _XLSX_WORKBOOK_RELS)
+        zf.writestr('xl/styles.xml', _XLSX_STYLES_XML)
+        zf.writestr('xl/sharedStrings.xml', _XML_DECL + (
+            f'<sst xmlns="{_XLSX_NS}" uniqueCount="{len(shared_strings)}">'
+            + ''.join(f'<si><t xml:space="preserve">{_xml_text(text)}</t></si>' for text in shared_strings)
+            + '</sst>'
+        ))
         
-        # 1. 标题部分
-        ws.merge_cells('A1:R1')
-        ws['A1'] = "上海库克打印机有限公司开票清单"
-        ws['A1'].font = title_font
-        ws['A1'].alignment = center_alignment
-        
-        ws.merge_cells('A2:B2')
-        ws['A2'] = f"客户名称：{data_list[0]['company_name']}"
-        ws['A2'].font = Font(name="微软雅黑", size=11)
-        ws['A2'].alignment = left_alignment
-        
-        ws.merge_cells('C2:D2')
-        ws['C2'] = f"发票类型：{data_list[0]['invoice_type']}"
-        ws['C2'].font = Font(name="微软雅黑", size=11)
-        ws['C2'].alignment = left_alignment
-        
-        # 2. 列标题
-        headers_row3 = [
-            "客户名称", "机器位置", "IP地址", "设备型号", "设备序号",
-            f"{data_list[0]['first_date']}初始张数", "",
-            "基本费（元）", "包印张数", "",
-            f"{data_list[0]['second_date']}抄表张数", "",
-            "使用张数", "", "超张数", "", "", "", "", ""
-        ]
-        
-        headers_row4 = [
-            "", "", "", "", "", "黑色", "彩色", "", "黑色", "彩色",
-            "黑色", "彩色", "黑色", "彩色", "黑色", "彩色", "黑色", "彩色", "超印费小计"
-        ]
-        
-        # 填写第3行标题
-        for col, header in enumerate(headers_row3, 1):
-            if col > 19:
-                break
-            cell = ws.cell(row=3, column=col, value=header)
-            cell.font = header_font
-            cell.alignment = center_alignment
-            cell.fill = header_fill
-            cell.border = thin_border
-        
-        # 合并单元格
-        ws.merge_cells(start_row=3, start_column=6, end_row=3, end_column=7)
-        ws.merge_cells(start_row=3, start_column=9, end_row=3, end_column=10)
-        ws.merge_cells(start_row=3, start_column=11, end_row=3, end_column=12)
-        ws.merge_cells(start_row=3, start_column=13, end_row=3, end_column=14)
-        ws.merge_cells(start_row=3, start_column=15, end_row=3, end_column=16)
-        ws.merge_cells(start_row=3, start_column=17, end_row=3, end_column=19)
-        
-        # 重新设置合并单元格样式
-        for start_col in [6, 9, 11, 13, 15, 17]:
-            merged_cell = ws.cell(row=3, column=start_col)
-            merged_cell.font = header_font
-            merged_cell.alignment = center_alignment
-            merged_cell.fill = header_fill
-            merged_cell.border = thin_border
-        
-        # 填写第4行标题
-        for col, header in enumerate(headers_row4, 1):
-            if col > 19:
-                break
-            cell = ws.cell(row=4, column=col, value=header)
-            cell.font = header_font
-            cell.alignment = center_alignment
-            cell.fill = header_fill
-            cell.border = thin_border
-        
-        # 3. 填写数据行
-        data_start_row = 5
-        total_over_fee = 0.0
-        total_basic_fee = 0.0
-        total_all_fee = 0.0
-        
-        # 按客户名称分组
-        customer_groups = {}
-        for data in data_list:
-            if data['company_name'] not in customer_groups:
-                customer_groups[data['company_name']] = []
-            customer_groups[data['company_name']].append(data)
-        
-        # 遍历分组填写数据
-        current_row = data_start_row
-        for company_name, group_data in customer_groups.items():
-            # 客户分组标题
-            ws.merge_cells(f'A{current_row}:R{current_row}')
-            group_cell = ws.cell(row=current_row, column=1, value=f"【{company_name}】")
-            group_cell.font = Font(name="微软雅黑", size=10, bold=True)
-            group_cell.alignment = center_alignment
-            group_cell.fill = PatternFill(start_color="F0F8FF", end_color="F0F8FF", fill_type="solid")
-            current_row += 1
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as f:
+            f.write((_XML_DECL + f'<worksheet xmlns="{_XLSX_NS}" xmlns:r="{_XLSX_REL_NS}">'
+                     f'{_XLSX_COLS_XML}<sheetData>').encode('utf-8'))
             
-            # 填写明细数据
-            for data in group_data:
-                basic_fee_display = f"{data['basic_fee']:.2f}"
-                
-                row_data = [
-                    company_name, data['location'], data['ip'], data['model'], data['serial'],
-                    data['first_black'], data['first_color'], basic_fee_display,
-                    data['package_black'], data['package_color'],
-                    data['second_black'], data['second_color'],
-                    data['used_black'], data['used_color'],
-                    data['over_black'], data['over_color'],
-                    data['over_fee_black'], data['over_fee_color'],
-                    data['over_fee_black'] + data['over_fee_color']
-                ]
+            buffer = []
+            for row, height, row_style, cells, merges in rows:
+                r = row + 1
+                parts = [f'<row r="{r}" ht="{height}" customHeight="1">' if height else f'<row r="{r}">']
+                if row_style:
+                    # 整行同一样式：值列表与列号直接对应
+                    s_attr = style_attrs[row_style]
+                    row_cells = zip(_COL_LETTERS, cells, itertools.repeat(s_attr))
+                else:
+                    row_cells = ((_COL_LETTERS[col], cell[0], style_attrs[cell[1]])
+                                 for col, cell in enumerate(cells) if cell is not None)
+                for letter, value, s_attr in row_cells:
+                    head = f'<c r="{letter}{r}"{s_attr}'
+                    if value is None or value == "":
+                        parts.append(head + '/>')
+                    elif isinstance(value, str):
+                        if value in sst_index:
+                            parts.append(f'{head} t="s"><v>{sst_index[value]}</v></c>')
+                        else:
+                            parts.append(f'{head} t="inlineStr"><is><t xml:space="preserve">'
+                                         f'{_xml_text(value)}</t></is></c>')
+                    else:
+                        parts.append(f'{head}><v>{value}</v></c>')
+                parts.append('</row>')
+                buffer.append(''.join(parts))
                 
-                for col, value in enumerate(row_data, 1):
-                    if col > 19:
-                        break
-                    cell = ws.cell(row=current_row, column=col, value=value)
-                    cell.font = normal_font
-                    cell.alignment = center_alignment
-                    cell.border = thin_border
+                for first_col, last_col in merges:
+                    merge_refs.append(f'<mergeCell ref="{_COL_LETTERS[first_col]}{r}:'
+                                      f'{_COL_LETTERS[last_col]}{r}"/>')
                 
-                total_over_fee += data['over_fee_black'] + data['over_fee_color']
-                total_basic_fee += data['basic_fee']
-                total_all_fee += data['total_fee']
-                current_row += 1
-        
-        # 4. 汇总行
-        summary_row = current_row + 3
-        period = data_list[0]['period']
-        
-        # 租赁费汇总
-        ws.merge_cells(f'A{summary_row}:B{summary_row}')
-        ws[f'A{summary_row}'] = "租赁费"
-        ws[f'A{summary_row}'].font = header_font
-        ws[f'A{summary_row}'].alignment = center_alignment
-        ws[f'A{summary_row}'].fill = header_fill
-        ws[f'A{summary_row}'].border = no_border
-        
-        ws[f'C{summary_row}'] = period
-        ws[f'C{summary_row}'].font = normal_font
-        ws[f'C{summary_row}'].alignment = center_alignment
-        ws[f'C{summary_row}'].border = no_border
-        
-        ws[f'E{summary_row}'] = f"¥{total_basic_fee:.2f}"
-        ws[f'E{summary_row}'].font = normal_font
-        ws[f'E{summary_row}'].alignment = center_alignment
-        ws[f'E{summary_row}'].border = no_border
-        
-        # 超印费汇总
-        summary_row2 = summary_row + 1
-        ws.merge_cells(f'A{summary_row2}:B{summary_row2}')
-        ws[f'A{summary_row2}'] = "超印费"
-        ws[f'A{summary_row2}'].font = header_font
-        ws[f'A{summary_row2}'].alignment = center_alignment
-        ws[f'A{summary_row2}'].fill = header_fill
-        ws[f'A{summary_row2}'].border = no_border
-        
-        ws[f'C{summary_row2}'] = f"{data_list[0]['first_date'][:7]}-{data_list[0]['second_date'][:7]}"
-        ws[f'C{summary_row2}'].font = normal_font
-        ws[f'C{summary_row2}'].alignment = center_alignment
-        ws[f'C{summary_row2}'].border = no_border
-        
-        ws[f'E{summary_row2}'] = f"¥{total_over_fee:.2f}"
-        ws[f'E{summary_row2}'].font = normal_font
-        ws[f'E{summary_row2}'].alignment = center_alignment
-        ws[f'E{summary_row2}'].border = no_border
-        
-        # 总费用汇总
-        summary_row3 = summary_row2 + 1
-        ws.merge_cells(f'A{summary_row3}:D{summary_row3}')
-        ws[f'A{summary_row3}'] = "总费用"
-        ws[f'A{summary_row3}'].font = Font(name="微软雅黑", size=12, bold=True)
-        ws[f'A{summary_row3}'].alignment = center_alignment
-        ws[f'A{summary_row3}'].fill = total_fill
-        ws[f'A{summary_row3}'].border = no_border
-        
-        ws[f'E{summary_row3}'] = f"¥{total_all_fee:.2f}"
-        ws[f'E{summary_row3}'].font = Font(name="微软雅黑", size=12, bold=True)
-        ws[f'E{summary_row3}'].alignment = center_alignment
-        ws[f'E{summary_row3}'].border = no_border
-        ws[f'E{summary_row3}'].fill = total_fill
-        
-        # 调整列宽
-        column_widths = [20, 25, 15, 18, 18, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 12, 15]
-        for col, width in enumerate(column_widths, 1):
-            if col > 19:
-                break
-            ws.column_dimensions[chr(64 + col)].width = width
-        
-        # 调整行高
-        ws.row_dimensions[1].height = 25
-        ws.row_dimensions[2].height = 20
-        ws.row_dimensions[3].height = 30
-        ws.row_dimensions[4].height = 20
-        
-        # 保存文件（统一路径）
-        filename = f"打印机费用清单_{datetime.now().strftime('%Y%m%d%H%M%S')}.xlsx"
-        save_path = resource_path(filename)
-        wb.save(save_path)
+                if len(buffer) >= 1000:
+                    f.write(''.join(buffer).encode('utf-8'))
+                    buffer.clear()
+            
+            buffer.append('</sheetData>')
+            if merge_refs:
+                buffer.append(f'<mergeCells count="{len(merge_refs)}">{"".join(merge_refs)}</mergeCells>')
+            buffer.append('</worksheet>')
+            f.write(''.join(buffer).encode('utf-8'))
+
+def _write_xlsx_xlsxwriter(save_path, rows):
+    """使用xlsxwriter生成xlsx（constant_memory模式，作为直接生成失败时的后备）"""
+    wb = xlsxwriter.Workbook(save_path, {'constant_memory': True})
+    ws = wb.add_worksheet(EXPORT_SHEET_NAME)
+    formats = {name: wb.add_format(fmt) for name, fmt in EXPORT_STYLES.items()}
+    
+    for col, width in enumerate(COLUMN_WIDTHS):
+        ws.set_column(col, col, width)
+    
+    for row, height, row_style, cells, merges in rows:
+        # constant_memory模式下行高需在写入该行前设置
+        if height:
+            ws.set_row(row, height)
+        if row_style:
+            # 整行同一样式：一次写入整行
+            ws.write_row(row, 0, cells, formats[row_style])
+            for first_col, last_col in merges:
+                ws.merge_range(row, first_col, row, last_col, cells[first_col], formats[row_style])
+            continue
+        for col, cell in enumerate(cells):
+            if cell is not None:
+                ws.write(row, col, cell[0], formats[cell[1]])
+        for first_col, last_col in merges:
+            value, style = cells[first_col]
+            ws.merge_range(row, first_col, row, last_col, value, formats[style])
+    
+    wb.close()
+
+def _write_export_segment(save_path, conn, first, offset, limit, totals, shared_strings):
+    """生成一个导出文件（一段明细），直接生成失败时重新读取该段并改用xlsxwriter"""
+    try:
+        _write_xlsx_xml(save_path, _iter_export_rows(first, get_calculations_grouped(conn, offset, limit), totals),
+                        shared_strings)
+    except Exception as e:
+        print(f"直接生成xlsx失败，改用xlsxwriter：{str(e)}")
+        _write_xlsx_xlsxwriter(save_path,
+                               _iter_export_rows(first, get_calculations_grouped(conn, offset, limit), totals))
+
+def export_to_excel(config=DEFAULT_CONFIG, segment_size=EXPORT_SEGMENT_SIZE):
+    """Excel导出逻辑（逐行流式读取并直接生成xlsx，失败时退回xlsxwriter）
+    
+    明细超过segment_size条时按段拆分为多个xlsx（每个文件均带表头，汇总行在最后一个文件），
+    并打包为一个zip供下载
+    """
+    try:
+        with get_read_conn() as c:
+            first = c.execute('''
+            SELECT * FROM calculation_history ORDER BY calculate_time DESC LIMIT 1
+            ''').fetchone()
+            if first is None:
+                return {"success": False, "error": "暂无计算数据可导出"}
+            
+            # 汇总金额
+            totals = get_calculation_totals(c)
+            
+            # 重复出现的标题、公司名称写入共享字符串表
+            companies = [row[0] for row in c.execute(
+                "SELECT DISTINCT company_name FROM calculation_history WHERE company_name != ''")]
+            shared_strings = list(dict.fromkeys(
+                [text for text in _export_headers_row3(first) + HEADERS_ROW4 if text]
+                + SUMMARY_LABELS
+                + companies
+            ))
+            
+            # 保存文件（统一路径）；时间戳后加随机后缀，同一秒内的多个导出任务互不覆盖
+            stem = f"打印机费用清单_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+            row_count = c.execute('SELECT COUNT(*) FROM calculation_history').fetchone()[0]
+            segment_count = max(1, -(-row_count // segment_size))
+            if segment_count == 1:
+                filenames = [f"{stem}.xlsx"]
+                filename = filenames[0]
+                save_path = resource_path(filename)
+                _write_export_segment(save_path, c, first, 0, -1, totals, shared_strings)
+            else:
+                filenames = [f"{stem}_{seg}.xlsx" for seg in range(1, segment_count + 1)]
+                filename = f"{stem}.zip"
+                save_path = resource_path(filename)
+                # 分段文件写入本任务独占的临时目录，打包为zip后随目录一起删除（xlsx本身已压缩，直接存储）
+                try:
+                    with tempfile.TemporaryDirectory() as tmp_dir, \
+                            zipfile.ZipFile(save_path, 'w', zipfile.ZIP_STORED) as zf:
+                        for seg, segment_name in enumerate(filenames):
+                            is_last = seg == segment_count - 1
+                            segment_path = os.path.join(tmp_dir, segment_name)
+                            _write_export_segment(segment_path, c, first,
+                                                  seg * segment_size, -1 if is_last else segment_size,
+                                                  totals if is_last else None, shared_strings)
+                            zf.write(segment_path, segment_name)
+                except Exception:
+                    # 不保留不完整的zip
+                    if os.path.exists(save_path):
+                        os.remove(save_path)
+                    raise
         
         return {
             "success": True,
             "filename": filename,
+            "filenames": filenames,
             "path": save_path,
-            "total_basic_fee": total_basic_fee,
-            "total_over_fee": total_over_fee,
-            "total_all_fee": total_all_fee
+            **totals
         }
     except Exception as e:
         return {
@@ -687,6 +959,24 @@ app = Flask(__name__,
             static_folder=resource_path("static"),
             template_folder=resource_path("templates"))
 CORS(app)  # 跨域支持
+cache.init_app(app)
+
+# JSON响应压缩（列表类接口返回体重复字段多，压缩率高；小响应不压缩）
+app.config['COMPRESS_MIMETYPES'] = ['application/json', 'application/x-ndjson']
+app.config['COMPRESS_LEVEL'] = 6
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+# 流式响应（/api/history）可用的压缩算法：不支持gzip，仅支持gzip的客户端收到未压缩的流
+app.config['COMPRESS_ALGORITHM_STREAMING'] = ['zstd', 'br', 'deflate']
+Compress(app)
+
+# 后台导出任务：Excel导出耗时与记录数成正比，放到线程池中执行，避免阻塞请求线程
+EXECUTOR = ThreadPoolExecutor(max_workers=2)
+_FUTURES = {}
+# 任务表最多保留的任务数（已完成但从未查询的任务按提交顺序淘汰）
+MAX_EXPORT_JOBS = 100
+# 导出文件名格式（下载接口只允许完整匹配此格式的文件，使用fullmatch）
+EXPORT_FILENAME_PATTERN = re.compile(r'打印机费用清单_\d{14}(_[0-9a-f]{8})?\.(xlsx|zip)')
 
 # ========================= Flask路由 =========================
 @app.route('/')
@@ -736,61 +1026,179 @@ def api_get_last_meter_data():
     except Exception as e:
         return jsonify({"success": False, "error": f"服务器错误：{str(e)}"}), 500
 
+def msgspec_response(payload, status=200):
+    """使用msgspec序列化JSON响应（支持Struct）"""
+    return app.response_class(msgspec.json.encode(payload), status=status, mimetype='application/json')
+
 @app.route('/api/calculate', methods=['POST'])
 def api_calculate():
     """计算费用"""
     try:
         if not request.is_json:
             return jsonify({"success": False, "error": "请求格式必须为JSON"}), 400
-        data = request.get_json()
+        try:
+            calc = CALC_DECODER.decode(request.get_data())
+        except msgspec.ValidationError as e:
+            if not request.get_data().lstrip().startswith(b'{'):
+                return jsonify({"success": False, "error": "请求数据必须为JSON对象"}), 400
+            return jsonify({"success": False, "error": f"数字输入错误：{str(e)}"})
+        except msgspec.DecodeError:
+            return jsonify({"success": False, "error": "请求格式必须为JSON"}), 400
         
         # 验证输入
-        validate_result = validate_inputs(data)
+        validate_result = validate_inputs(calc)
         if not validate_result["valid"]:
             return jsonify({"success": False, "error": validate_result["error"]})
         
         # 保存/更新客户信息
-        company_name = data.get('company_name', '')
-        invoice_type = data.get('invoice_type', '增税')
-        customer_id = add_or_update_customer(company_name, invoice_type)
-        data['customer_id'] = customer_id
+        calc.customer_id = add_or_update_customer(calc.company_name, calc.invoice_type)
         
         # 计算费用
-        calc_result = calculate_cost(data)
-        if calc_result["success"]:
-            add_calculation(calc_result["data"])
-        return jsonify(calc_result)
+        result = calculate_cost(calc)
+        add_calculation(msgspec.structs.asdict(result))
+        return msgspec_response({"success": True, "data": result, "warnings": []})
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误：{str(e)}"}), 500
+
+@app.route('/api/calculate-batch', methods=['POST'])
+def api_calculate_batch():
+    """批量计算费用（请求体为计算数据数组，全部通过验证后一次性保存）"""
+    try:
+        if not request.is_json:
+            return jsonify({"success": False, "error": "请求格式必须为JSON"}), 400
+        try:
+            calc_list = CALC_BATCH_DECODER.decode(request.get_data())
+        except msgspec.ValidationError as e:
+            if not request.get_data().lstrip().startswith(b'['):
+                return jsonify({"success": False, "error": "请求数据必须为非空数组"}), 400
+            return jsonify({"success": False, "error": f"数字输入错误：{str(e)}"})
+        except msgspec.DecodeError:
+            return jsonify({"success": False, "error": "请求格式必须为JSON"}), 400
+        if not calc_list:
+            return jsonify({"success": False, "error": "请求数据必须为非空数组"}), 400
+        
+        # 验证输入
+        for index, calc in enumerate(calc_list, 1):
+            validate_result = validate_inputs(calc)
+            if not validate_result["valid"]:
+                return jsonify({"success": False, "error": f"第{index}条：{validate_result['error']}"})
+        
+        # 保存/更新客户信息（同一客户只处理一次）并计算费用
+        customer_ids = {}
+        results = []
+        for calc in calc_list:
+            if calc.company_name not in customer_ids:
+                customer_ids[calc.company_name] = add_or_update_customer(
+                    calc.company_name, calc.invoice_type)
+            calc.customer_id = customer_ids[calc.company_name]
+            results.append(calculate_cost(calc))
+        
+        add_calculations([msgspec.structs.asdict(result) for result in results])
+        return msgspec_response({"success": True, "data": results, "warnings": []})
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误：{str(e)}"}), 500
+
+@app.route('/api/history')
+def api_history():
+    """计算历史（NDJSON流式返回，每行一条记录；可选参数company_name）
+    
+    流式响应不使用gzip压缩（可用算法见COMPRESS_ALGORITHM_STREAMING）
+    """
+    try:
+        company_name = request.args.get('company_name', '').strip()
+        rows = iter_calculations(company_name)
+        # 先取第一条：连接、查询出错时仍可返回500，而不是中断已开始的200响应
+        first = next(rows, None)
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误：{str(e)}"}), 500
+    
+    def generate():
+        if first is None:
+            return
+        yield orjson.dumps(dict(first)) + b'\n'
+        for row in rows:
+            yield orjson.dumps(dict(row)) + b'\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/history/legacy')
+def api_history_legacy():
+    """计算历史（一次性返回JSON数组，兼容旧版页面）"""
+    try:
+        company_name = request.args.get('company_name', '').strip()
+        if company_name:
+            return jsonify({"success": True, "data": get_customer_calculations(company_name)})
+        return jsonify({"success": True, "data": get_all_calculations()})
     except Exception as e:
         return jsonify({"success": False, "error": f"服务器错误：{str(e)}"}), 500
 
 @app.route('/api/export-excel', methods=['POST'])
 def api_export_excel():
-    """导出Excel"""
+    """提交Excel导出任务（立即返回任务ID，通过/api/export-status查询进度）
+    
+    可选JSON参数 segment_size：单个文件最多的明细行数，超出时分段导出为zip
+    """
+    try:
+        data = request.get_json(silent=True)
+        if data is None:
+            data = {}
+        segment_size = data.get('segment_size', EXPORT_SEGMENT_SIZE) if isinstance(data, dict) else None
+        if isinstance(segment_size, bool) or not isinstance(segment_size, int) \
+                or not 0 < segment_size <= 1000000:
+            return jsonify({"success": False, "error": "分段行数必须为1~1000000之间的整数"}), 400
+        
+        stale = [key for key, future in list(_FUTURES.items()) if future.done()]
+        for key in stale[:max(0, len(_FUTURES) - MAX_EXPORT_JOBS + 1)]:
+            _FUTURES.pop(key, None)
+        
+        job_id = uuid.uuid4().hex
+        _FUTURES[job_id] = EXECUTOR.submit(export_to_excel, segment_size=segment_size)
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "status_url": f"/api/export-status/{job_id}"
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": f"导出失败：{str(e)}"}), 500
+
+@app.route('/api/export-status/<job_id>')
+def api_export_status(job_id):
+    """查询Excel导出任务状态：pending / done / error（返回done/error后任务即从任务表移除）"""
     try:
-        export_result = export_to_excel()
+        future = _FUTURES.get(job_id)
+        if future is None:
+            return jsonify({"success": False, "error": "导出任务不存在"}), 404
+        if not future.done():
+            return jsonify({"success": True, "status": "pending"})
+        
+        _FUTURES.pop(job_id, None)
+        export_result = future.result()
         if export_result["success"]:
             return jsonify({
                 "success": True,
+                "status": "done",
                 "filename": export_result["filename"],
+                "filenames": export_result["filenames"],
                 "download_url": f"/download/{export_result['filename']}",
                 "total_basic_fee": export_result["total_basic_fee"],
                 "total_over_fee": export_result["total_over_fee"],
                 "total_all_fee": export_result["total_all_fee"]
             })
-        else:
-            return jsonify(export_result)
+        return jsonify({"success": False, "status": "error", "error": export_result["error"]})
     except Exception as e:
-        return jsonify({"success": False, "error": f"导出失败：{str(e)}"}), 500
+        return jsonify({"success": False, "status": "error", "error": f"导出失败：{str(e)}"}), 500
 
 @app.route('/download/<filename>')
 def download_file(filename):
     """下载文件"""
     try:
-        file_path = resource_path(filename)
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
-        else:
+        # 只允许下载导出生成的清单文件
+        if not EXPORT_FILENAME_PATTERN.fullmatch(filename):
             return jsonify({"success": False, "error": "文件不存在"}), 404
+        return send_from_directory(resource_path('.'), filename, as_attachment=True,
+                                   conditional=True, max_age=0)
+    except NotFound:
+        return jsonify({"success": False, "error": "文件不存在"}), 404
     except Exception as e:
         return jsonify({"success": False, "error": f"下载失败：{str(e)}"}), 500
 
@@ -804,6 +1212,20 @@ def clear_history():
         return jsonify({"success": False, "error": f"清空失败：{str(e)}"}), 500
 
 # ========================= 程序入口（修复启动逻辑） =========================
+# Flask服务就绪标记：端口可连接后置位，主线程据此打开窗口
+READY = threading.Event()
+
+def _wait_port(port, host='127.0.0.1', timeout=10):
+    """轮询端口直到可以建立连接（或超时）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), 0.05):
+                return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
 def run_server():
     """启动Flask服务（统一参数）"""
     try:
@@ -812,6 +1234,8 @@ def run_server():
         os.makedirs(resource_path("static"), exist_ok=True)
         # 初始化数据库
         init_db()
+        # 端口可连接后通知主线程
+        threading.Thread(target=lambda: _wait_port(5000) and READY.set(), daemon=True).start()
         # 统一启动参数：禁用debug、自动重载，允许外部访问
         app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
     except Exception as e:
@@ -824,8 +1248,9 @@ def main():
     # 启动Flask服务（后台线程）
     flask_thread = threading.Thread(target=run_server, daemon=True)
     flask_thread.start()
-    # 延长等待时间，确保服务完全启动
-    time.sleep(3)
+    # 等待服务实际可访问（最多10秒）
+    if not READY.wait(timeout=10):
+        print("Flask服务启动超时，继续尝试打开窗口")
     
     # 尝试启动webview窗口，失败则用浏览器打开
     try: